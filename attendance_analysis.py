@@ -1,9 +1,15 @@
+import calendar
+import io
 import sys
 import os
+import numpy as np
 import pandas as pd
+from numba import njit
 from datetime import datetime, timedelta
 from cassandra.cluster import Cluster
 import logging
+import threading
+import time
 
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from config.config import CASSANDRA_HOSTS, CASSANDRA_KEYSPACE
@@ -11,45 +17,147 @@ from config.config import CASSANDRA_HOSTS, CASSANDRA_KEYSPACE
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Murmur3Partitioner token bounds; the minimum token is never assigned to a
+# partition, so (TOKEN_MIN, TOKEN_MAX] covers the whole ring
+TOKEN_MIN = -2**63
+TOKEN_MAX = 2**63 - 1
+TOKEN_RANGE_SPLITS = 64
+SCAN_CONCURRENCY = 32
+# Give up on a scan once no page has arrived for this many request timeouts
+SCAN_STALL_TIMEOUT_FACTOR = 3
+
+@njit(cache=True)
+def _student_counts(codes, hours, is_valid, late_threshold, n_students):
+    """Count total, late and invalid records per factorized student code."""
+    total = np.zeros(n_students, np.int64)
+    late = np.zeros(n_students, np.int64)
+    invalid = np.zeros(n_students, np.int64)
+    for i in range(codes.size):
+        c = codes[i]
+        total[c] += 1
+        if hours[i] >= late_threshold:
+            late[c] += 1
+        if not is_valid[i]:
+            invalid[c] += 1
+    return total, late, invalid
+
+class _TokenRangeScan:
+    """Read every page of a set of token ranges without blocking on any of them.
+
+    Up to ``concurrency`` ranges are in flight at once. Each range's later
+    pages are requested from its page callback, so no page is ever fetched
+    synchronously on the calling thread.
+    """
+
+    def __init__(self, session, statement, ranges, concurrency):
+        self.session = session
+        self.statement = statement
+        self.ranges = iter(ranges)
+        self.concurrency = concurrency
+        self.pages = []
+        self.active = 0
+        self.error = None
+        # Reentrant: a callback can fire inline while a range is being started
+        self.lock = threading.RLock()
+        self.done = threading.Event()
+        self.last_progress = time.monotonic()
+
+    def fetch(self):
+        """Return the rows of every page, in no particular order."""
+        with self.lock:
+            for _ in range(self.concurrency):
+                self._start_next_range()
+        stall_timeout = self.session.default_timeout * SCAN_STALL_TIMEOUT_FACTOR
+        while not self.done.wait(stall_timeout):
+            if time.monotonic() - self.last_progress > stall_timeout:
+                raise TimeoutError(
+                    f"Token range scan made no progress for {stall_timeout:.0f}s"
+                )
+        if self.error is not None:
+            raise self.error
+        return self.pages
+
+    def _start_next_range(self):
+        # Also runs on the driver's event loop thread, see _on_page
+        try:
+            bounds = next(self.ranges, None)
+            if bounds is None:
+                if self.active == 0:
+                    self.done.set()
+                return
+            self.active += 1
+            future = self.session.execute_async(self.statement, bounds)
+            future.add_callbacks(
+                self._on_page,
+                self._on_error,
+                callback_args=(future,)
+            )
+        except BaseException as e:
+            self._on_error(e)
+
+    def _on_page(self, rows, future):
+        # The driver swallows callback exceptions, so report them here or
+        # fetch() would never be woken up
+        try:
+            self.last_progress = time.monotonic()
+            self.pages.append(rows)
+            if future.has_more_pages:
+                future.start_fetching_next_page()
+                return
+            with self.lock:
+                self.active -= 1
+                self._start_next_range()
+        except BaseException as e:
+            self._on_error(e)
+
+    def _on_error(self, error):
+        self.error = error
+        self.done.set()
+
 class AttendanceAnalyzer:
     def __init__(self):
-        self.cluster = Cluster(CASSANDRA_HOSTS)
+        self.cluster = Cluster(CASSANDRA_HOSTS, protocol_version=4)
         self.session = self.cluster.connect(CASSANDRA_KEYSPACE)
+        self.range_query = self.session.prepare("""
+            SELECT student_id, lecture_id, timestamp, is_valid
+            FROM attendance
+            WHERE token(lecture_id) > ? AND token(lecture_id) <= ?
+        """)
+        self.range_query.fetch_size = 5000
 
     def _fetch_attendance_data(self):
         """Fetch attendance data from Cassandra."""
-        # First get all unique lecture IDs
-        lecture_query = "SELECT DISTINCT lecture_id FROM attendance"
-        lecture_rows = self.session.execute(lecture_query)
-        lecture_ids = [row.lecture_id for row in lecture_rows]
-        
-        if not lecture_ids:
-            logger.warning("No lectures found in the database")
-            return pd.DataFrame()
-        
-        # Fetch all attendance records
-        all_records = []
-        for lecture_id in lecture_ids:
-            query = """
-                SELECT student_id, lecture_id, timestamp, is_valid
-                FROM attendance
-                WHERE lecture_id = %s
-                ALLOW FILTERING
-            """
-            rows = self.session.execute(query, [lecture_id])
+        # Split the Murmur3 token ring into contiguous (lo, hi] slices so the
+        # full scan is served by several coordinators in parallel
+        step = (TOKEN_MAX - TOKEN_MIN) // TOKEN_RANGE_SPLITS
+        bounds = [TOKEN_MIN + i * step for i in range(TOKEN_RANGE_SPLITS)] + [TOKEN_MAX]
+        ranges = list(zip(bounds[:-1], bounds[1:]))
+
+        pages = _TokenRangeScan(
+            self.session,
+            self.range_query,
+            ranges,
+            SCAN_CONCURRENCY
+        ).fetch()
+
+        student_ids, lecture_ids, timestamps, validity = [], [], [], []
+        for rows in pages:
             for row in rows:
-                all_records.append({
-                    'student_id': row.student_id,
-                    'lecture_id': row.lecture_id,
-                    'timestamp': row.timestamp,
-                    'is_valid': row.is_valid
-                })
-        
-        if not all_records:
+                student_ids.append(row.student_id)
+                lecture_ids.append(row.lecture_id)
+                timestamps.append(row.timestamp)
+                validity.append(row.is_valid)
+        
+        if not student_ids:
             logger.warning("No attendance records found")
             return pd.DataFrame()
             
-        return pd.DataFrame(all_records)
+        return pd.DataFrame({
+            'student_id': np.asarray(student_ids, dtype=np.int32),
+            'lecture_id': lecture_ids,
+            'timestamp': np.asarray(timestamps, dtype='datetime64[ns]'),
+            'is_valid': np.asarray(validity, dtype=bool)
+        })
 
     def generate_insights(self):
         """Generate insights from attendance data."""
@@ -62,10 +170,30 @@ class AttendanceAnalyzer:
         
         insights = []
         
-        # 1. Identify habitual latecomers
-        df['hour'] = pd.to_datetime(df['timestamp']).dt.hour
+        # Timestamps already arrive as datetime64[ns], so no parsing is needed;
+        # keep derived fields as local arrays rather than DataFrame columns
+        ts = df['timestamp'].dt
+        hours = ts.hour.to_numpy(np.int8)
+        days_of_week = ts.dayofweek.to_numpy(np.int8)
+        
         late_threshold = 9  # 9 AM
-        late_students = df[df['hour'] >= late_threshold].groupby('student_id').size()
+        
+        # Single pass over the student axis shared by insights 1, 4 and 5
+        codes, uniques = pd.factorize(df['student_id'], sort=False)
+        total, late, invalid = _student_counts(
+            codes.astype(np.int32),
+            hours,
+            df['is_valid'].to_numpy(bool),
+            late_threshold,
+            len(uniques)
+        )
+        per_student = pd.DataFrame(
+            {'total': total, 'late': late, 'invalid': invalid},
+            index=pd.Index(uniques, name='student_id')
+        )
+        
+        # 1. Identify habitual latecomers
+        late_students = per_student['late'][per_student['late'] > 0]
         frequent_late = late_students[late_students > late_students.median()]
         
         insights.append({
@@ -75,13 +203,16 @@ class AttendanceAnalyzer:
         })
         
         # 2. Attendance patterns by day of week
-        df['day_of_week'] = pd.to_datetime(df['timestamp']).dt.day_name()
-        day_patterns = df.groupby('day_of_week').size()
+        day_counts = np.bincount(days_of_week, minlength=7)
+        day_patterns = {
+            calendar.day_name[day]: int(count)
+            for day, count in enumerate(day_counts) if count
+        }
         
         insights.append({
             'title': 'Attendance by Day',
             'description': 'Distribution of attendance across different days',
-            'data': day_patterns.to_dict()
+            'data': day_patterns
         })
         
         # 3. Most and least attended lectures
@@ -97,10 +228,9 @@ class AttendanceAnalyzer:
         })
         
         # 4. Consistency analysis
-        student_consistency = df.groupby('student_id').size()
-        consistent_students = student_consistency[
-            student_consistency > student_consistency.median() + student_consistency.std()
-        ]
+        # Threshold straight from the counts array; ddof=1 matches Series.std()
+        consistency_threshold = np.median(total) + total.std(ddof=1)
+        consistent_students = per_student['total'][total > consistency_threshold]
         
         insights.append({
             'title': 'Most Consistent Attendees',
@@ -109,7 +239,7 @@ class AttendanceAnalyzer:
         })
         
         # 5. Invalid attendance attempts
-        invalid_attempts = df[~df['is_valid']].groupby('student_id').size()
+        invalid_attempts = per_student['invalid'][per_student['invalid'] > 0]
         
         insights.append({
             'title': 'Invalid Attendance Attempts',
@@ -124,22 +254,28 @@ class AttendanceAnalyzer:
         if not insights:
             print("\nNo insights available - no attendance data found.")
             return
-            
+        
+        # Format everything into one buffer and write it out in a single call
+        buf = io.StringIO()
         for insight in insights:
-            print(f"\n=== {insight['title']} ===")
-            print(insight['description'])
-            print("Data:")
+            buf.write(f"\n=== {insight['title']} ===\n")
+            buf.write(f"{insight['description']}\n")
+            buf.write("Data:\n")
             if isinstance(insight['data'], dict) and insight['data']:
-                for key, value in insight['data'].items():
-                    if isinstance(value, dict):
-                        print(f"\n{key}:")
-                        for k, v in value.items():
-                            print(f"  {k}: {v}")
-                    else:
-                        print(f"{key}: {value}")
+                self._format_data(buf, insight['data'])
+            else:
+                buf.write("No data available\n")
+            buf.write("-" * 50 + "\n")
+        sys.stdout.write(buf.getvalue())
+
+    def _format_data(self, buf, data, indent=""):
+        """Write a possibly nested insight dict into buf, one key per line."""
+        for key, value in data.items():
+            if isinstance(value, dict):
+                buf.write(f"\n{indent}{key}:\n")
+                self._format_data(buf, value, indent + "  ")
             else:
-                print("No data available")
-            print("-" * 50)
+                buf.write(f"{indent}{key}: {value}\n")
 
     def cleanup(self):
         """Clean up Cassandra connection."""
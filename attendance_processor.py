@@ -1,4 +1,4 @@
-import json
+import orjson
 import sys
 import os
 from datetime import datetime
@@ -7,13 +7,15 @@ from cassandra.cluster import Cluster
 from cassandra.query import SimpleStatement
 import redis
 import logging
+import threading
 from faker import Faker
 
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from config.config import (
     PULSAR_HOST, PULSAR_TOPIC, REDIS_HOST, REDIS_PORT,
     CASSANDRA_HOSTS, CASSANDRA_KEYSPACE, BLOOM_FILTER_KEY,
-    BLOOM_FILTER_ERROR_RATE, BLOOM_FILTER_CAPACITY, HLL_KEY_PREFIX
+    BLOOM_FILTER_CAPACITY, CUCKOO_FILTER_BUCKET_SIZE, CUCKOO_FILTER_TYPE,
+    HLL_KEY_PREFIX
 )
 
 # Configure logging
@@ -23,6 +25,25 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Checks the student ID against the Cuckoo Filter and, only if it is valid,
+# counts it in the lecture's HyperLogLog. KEYS: cuckoo filter, HLL key.
+VALIDATE_ATTENDANCE_SCRIPT = """
+local valid = redis.call('CF.EXISTS', KEYS[1], ARGV[1])
+if valid == 1 then
+    redis.call('PFADD', KEYS[2], ARGV[1])
+end
+return valid
+"""
+
+# Upper bound on Cassandra writes awaiting a response
+MAX_IN_FLIGHT_WRITES = 256
+
+# Seconds to wait for in-flight writes when shutting down
+WRITE_DRAIN_TIMEOUT = 30
+
+# Page size used when streaming a lecture's attendance records
+STATS_FETCH_SIZE = 1000
+
 class AttendanceProcessor:
     def __init__(self):
         # Initialize Pulsar client
@@ -40,6 +61,9 @@ class AttendanceProcessor:
             decode_responses=True
         )
 
+        # Cuckoo Filter check and HyperLogLog update share one round trip
+        self.validate_attendance = self.redis_client.register_script(VALIDATE_ATTENDANCE_SCRIPT)
+
         # Initialize Cassandra client
         self.cassandra_cluster = Cluster(CASSANDRA_HOSTS)
         self.cassandra_session = self.cassandra_cluster.connect()
@@ -47,6 +71,15 @@ class AttendanceProcessor:
         # Create keyspace and tables if they don't exist
         self._setup_cassandra()
         
+        self.insert_attendance = self.cassandra_session.prepare("""
+            INSERT INTO attendance (
+                student_id, lecture_id, timestamp, is_valid
+            ) VALUES (?, ?, ?, ?)
+        """)
+        self.in_flight_writes = threading.BoundedSemaphore(MAX_IN_FLIGHT_WRITES)
+        self.pending_writes = set()
+        self.pending_writes_changed = threading.Condition()
+        
         # Initialize Faker for generating student IDs
         self.faker = Faker()
 
@@ -72,24 +105,29 @@ class AttendanceProcessor:
         """)
 
     def _setup_bloom_filter(self):
-        """Set up Bloom Filter in Redis if not already exists."""
+        """Set up the student ID Cuckoo Filter in Redis if not already exists."""
+        # Reserve unconditionally; an existing filter is reported as an error
         try:
-            # Check if Bloom Filter exists
-            exists = self.redis_client.execute_command('BF.EXISTS', BLOOM_FILTER_KEY, 'test')
-            logger.info("Bloom Filter already exists")
-        except redis.exceptions.ResponseError:
-            # Bloom Filter doesn't exist, create it
-            try:
-                self.redis_client.execute_command(
-                    'BF.RESERVE',
-                    BLOOM_FILTER_KEY,
-                    BLOOM_FILTER_ERROR_RATE,
-                    BLOOM_FILTER_CAPACITY
-                )
-                logger.info("Created new Bloom Filter")
-            except redis.exceptions.ResponseError as e:
-                if "already exists" not in str(e):
-                    raise
+            self.redis_client.execute_command(
+                'CF.RESERVE',
+                BLOOM_FILTER_KEY,
+                BLOOM_FILTER_CAPACITY,
+                'BUCKETSIZE',
+                CUCKOO_FILTER_BUCKET_SIZE
+            )
+            logger.info("Created new Cuckoo Filter")
+        except redis.exceptions.ResponseError as e:
+            if "exists" not in str(e):
+                raise
+            # The key may still hold a Bloom Filter from an older version,
+            # which would make every CF.EXISTS fail with WRONGTYPE
+            key_type = self.redis_client.type(BLOOM_FILTER_KEY)
+            if key_type != CUCKOO_FILTER_TYPE:
+                raise RuntimeError(
+                    f"Redis key {BLOOM_FILTER_KEY} holds a {key_type}, not a Cuckoo Filter; "
+                    f"delete it and reload student IDs"
+                ) from e
+            logger.info("Cuckoo Filter already exists")
 
     def process_attendance(self):
         """Process attendance messages from Pulsar."""
@@ -100,36 +138,49 @@ class AttendanceProcessor:
             while True:
                 msg = self.consumer.receive()
                 try:
-                    data = json.loads(msg.data().decode())
+                    data = orjson.loads(msg.data())
                     student_id = data['student_id']
                     lecture_id = data['lecture_id']
-                    timestamp = datetime.fromisoformat(data['timestamp'])
+                    # Epoch milliseconds bind directly to a timestamp column;
+                    # messages published before that change carry ISO strings
+                    timestamp = data['timestamp']
+                    if isinstance(timestamp, str):
+                        timestamp = datetime.fromisoformat(timestamp)
 
-                    # Check if student ID is valid using Bloom Filter
-                    is_valid = bool(self.redis_client.execute_command(
-                        'BF.EXISTS',
-                        BLOOM_FILTER_KEY,
-                        student_id
+                    # Check if student ID is valid using Cuckoo Filter and
+                    # add it to the lecture's HyperLogLog if so
+                    hll_key = f"{HLL_KEY_PREFIX}{lecture_id}"
+                    is_valid = bool(self.validate_attendance(
+                        keys=[BLOOM_FILTER_KEY, hll_key],
+                        args=[student_id]
                     ))
 
-                    # Store in Cassandra regardless of validity
-                    query = """
-                        INSERT INTO attendance (
-                            student_id, lecture_id, timestamp, is_valid
-                        ) VALUES (%s, %s, %s, %s)
-                    """
-                    self.cassandra_session.execute(
-                        query,
-                        (student_id, lecture_id, timestamp, is_valid)
-                    )
-
-                    # Only add to HyperLogLog if valid
-                    if is_valid:
-                        hll_key = f"{HLL_KEY_PREFIX}{lecture_id}"
-                        self.redis_client.pfadd(hll_key, student_id)
-
-                    logger.info(f"Processed attendance for student {student_id} (valid: {is_valid})")
-                    self.consumer.acknowledge(msg)
+                    # Store in Cassandra regardless of validity; the message
+                    # is acknowledged once the write completes
+                    self.in_flight_writes.acquire()
+                    future = None
+                    try:
+                        future = self.cassandra_session.execute_async(
+                            self.insert_attendance,
+                            (student_id, lecture_id, timestamp, is_valid)
+                        )
+                        with self.pending_writes_changed:
+                            self.pending_writes.add(future)
+                        future.add_callbacks(
+                            self._on_write_success,
+                            self._on_write_error,
+                            callback_args=(future, msg, student_id, is_valid),
+                            errback_args=(future, msg)
+                        )
+                    except BaseException:
+                        # Also covers KeyboardInterrupt, so the permit is
+                        # returned unless a callback has already done so
+                        with self.pending_writes_changed:
+                            if future is None or future in self.pending_writes:
+                                self.pending_writes.discard(future)
+                                self.in_flight_writes.release()
+                                self.pending_writes_changed.notify_all()
+                        raise
 
                 except Exception as e:
                     logger.error(f"Error processing message: {e}")
@@ -140,14 +191,56 @@ class AttendanceProcessor:
         finally:
             self._cleanup()
 
+    def _on_write_success(self, result, future, msg, student_id, is_valid):
+        """Acknowledge a message once its attendance row is stored."""
+        if self._finish_write(future):
+            logger.info(f"Processed attendance for student {student_id} (valid: {is_valid})")
+            self.consumer.acknowledge(msg)
+
+    def _on_write_error(self, error, future, msg):
+        """Negatively acknowledge a message whose write failed."""
+        if self._finish_write(future):
+            logger.error(f"Error storing attendance: {error}")
+            self.consumer.negative_acknowledge(msg)
+
+    def _finish_write(self, future):
+        """Stop tracking a completed write and return its in-flight permit.
+
+        Returns False if the write was already abandoned by the consumer loop.
+        """
+        with self.pending_writes_changed:
+            if future not in self.pending_writes:
+                return False
+            self.pending_writes.remove(future)
+            self.in_flight_writes.release()
+            self.pending_writes_changed.notify_all()
+        return True
+
+    def _wait_for_writes(self, timeout=WRITE_DRAIN_TIMEOUT):
+        """Wait up to timeout seconds for in-flight Cassandra writes to finish."""
+        with self.pending_writes_changed:
+            drained = self.pending_writes_changed.wait_for(
+                lambda: not self.pending_writes,
+                timeout
+            )
+            if not drained:
+                logger.warning(
+                    f"Shutting down with {len(self.pending_writes)} Cassandra writes still pending"
+                )
+
     def _cleanup(self):
         """Clean up connections."""
+        self._wait_for_writes()
         self.pulsar_client.close()
         self.redis_client.close()
         self.cassandra_cluster.shutdown()
 
-    def get_attendance_stats(self, lecture_id):
-        """Get attendance statistics for a lecture."""
+    def get_attendance_stats(self, lecture_id, limit=None):
+        """Get attendance statistics for a lecture.
+
+        Records are returned as a lazily paged result set rather than a list,
+        optionally capped at ``limit`` rows.
+        """
         hll_key = f"{HLL_KEY_PREFIX}{lecture_id}"
         unique_attendees = self.redis_client.pfcount(hll_key)
         
@@ -157,11 +250,18 @@ class AttendanceProcessor:
             FROM attendance
             WHERE lecture_id = %s
         """
-        rows = self.cassandra_session.execute(query, (lecture_id,))
+        params = (lecture_id,)
+        if limit is not None:
+            query += " LIMIT %s"
+            params += (limit,)
+        rows = self.cassandra_session.execute(
+            SimpleStatement(query, fetch_size=STATS_FETCH_SIZE),
+            params
+        )
         
         return {
             'unique_attendees': unique_attendees,
-            'attendance_records': list(rows)
+            'attendance_records': rows
         }
 
 if __name__ == "__main__":
@@ -1,9 +1,9 @@
-import time
+import calendar
 import random
-import json
+import orjson
 from datetime import datetime, timedelta
-from faker import Faker
-from pulsar import Client
+import numpy as np
+from pulsar import Client, CompressionType, Result
 import sys
 import os
 import logging
@@ -12,7 +12,8 @@ import redis
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from config.config import (
     PULSAR_HOST, PULSAR_TOPIC, REDIS_HOST, REDIS_PORT,
-    BLOOM_FILTER_KEY
+    BLOOM_FILTER_KEY, BLOOM_FILTER_CAPACITY, CUCKOO_FILTER_BUCKET_SIZE,
+    CUCKOO_FILTER_TYPE
 )
 
 # Configure logging
@@ -22,6 +23,9 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Maximum number of student IDs sent in a single CF.INSERTNX call
+BLOOM_FILTER_BATCH_SIZE = 10000
+
 def generate_random_timestamp(base_date=None):
     """Generate a random timestamp for a lecture day."""
     if base_date is None:
@@ -35,11 +39,62 @@ def generate_random_timestamp(base_date=None):
     
     return base_date.replace(hour=hour, minute=minute, second=0, microsecond=0)
 
+def _generate_attendance_schedule(rng, student_ids, n_days, n_invalid_ids=50):
+    """Draw per-record attendance arrays for every student in one shot.
+
+    Returns student IDs, day indexes, entry and exit offsets from midnight
+    (timedelta64[m]), a 15% invalid-attempt mask and the invalid ID index to
+    use for each record, all ordered by student then attended day.
+    """
+    n_students = len(student_ids)
+    
+    # 80% of students are generally punctual and each attends 3-7 days
+    is_punctual = rng.random(n_students) > 0.2
+    days_attended = rng.integers(3, 8, size=n_students)
+    
+    # Shuffle the week per student and keep the first days_attended days
+    day_order = rng.permuted(np.tile(np.arange(n_days), (n_students, 1)), axis=1)
+    rows, cols = np.nonzero(np.arange(n_days) < days_attended[:, None])
+    n_records = rows.size
+    
+    # Punctual students arrive between 8-9 AM, others between 9-11 AM
+    entry_hours = np.where(
+        is_punctual[rows],
+        rng.integers(8, 10, size=n_records),
+        rng.integers(9, 12, size=n_records)
+    )
+    entry_minutes = entry_hours * 60 + rng.integers(0, 60, size=n_records)
+    
+    # Students stay 3-4 hours
+    stay_minutes = rng.integers(3, 5, size=n_records) * 60 + rng.integers(0, 60, size=n_records)
+    
+    return (
+        np.asarray(student_ids)[rows],
+        day_order[rows, cols],
+        entry_minutes.astype('timedelta64[m]'),
+        (entry_minutes + stay_minutes).astype('timedelta64[m]'),
+        rng.random(n_records) < 0.15,
+        rng.integers(0, n_invalid_ids, size=n_records)
+    )
+
+def _on_send(result, msg_id):
+    """Log failed asynchronous sends."""
+    if result != Result.Ok:
+        logger.error(f"Failed to send attendance message: {result}")
+
 def generate_student_data():
     """Generate simulated student attendance data."""
     client = Client(PULSAR_HOST)
-    producer = client.create_producer(PULSAR_TOPIC)
-    faker = Faker()
+    producer = client.create_producer(
+        PULSAR_TOPIC,
+        batching_enabled=True,
+        batching_max_publish_delay_ms=10,
+        batching_max_messages=1000,
+        block_if_queue_full=True,
+        max_pending_messages=10000,
+        compression_type=CompressionType.LZ4
+    )
+    rng = np.random.default_rng()
     
     # Initialize Redis client to check valid student IDs
     redis_client = redis.Redis(
@@ -48,23 +103,9 @@ def generate_student_data():
         decode_responses=True
     )
     
-    # Pre-generate a set of valid student IDs
+    # Pre-generate 1000 distinct valid student IDs in [10000, 99999]
     logger.info("Generating valid student IDs...")
-    valid_student_ids = set(faker.unique.random_int(min=10000, max=99999) 
-                          for _ in range(1000))
-    
-    # Add valid IDs to Redis Bloom Filter
-    try:
-        for student_id in valid_student_ids:
-            redis_client.execute_command(
-                'BF.ADD',
-                BLOOM_FILTER_KEY,
-                student_id
-            )
-        logger.info(f"Added {len(valid_student_ids)} valid student IDs to Bloom Filter")
-    except redis.exceptions.ResponseError as e:
-        if "already exists" not in str(e):
-            logger.error(f"Error adding student IDs to Bloom Filter: {e}")
+    valid_student_ids = (rng.choice(90000, size=1000, replace=False) + 10000).tolist()
     
     # Generate attendance for the past week
     past_week_dates = [
@@ -72,97 +113,125 @@ def generate_student_data():
         for i in range(7)
     ]
     
+    message_count = 0
+    invalid_attempts = 0
+    
     try:
-        message_count = 0
-        invalid_attempts = 0
+        # A Bloom Filter left under the key by an older version cannot be loaded
+        key_type = redis_client.type(BLOOM_FILTER_KEY)
+        if key_type not in ("none", CUCKOO_FILTER_TYPE):
+            raise RuntimeError(
+                f"Redis key {BLOOM_FILTER_KEY} holds a {key_type}, not a Cuckoo Filter; "
+                f"delete it before generating data"
+            )
+        
+        # Add valid IDs to Redis Cuckoo Filter; INSERTNX skips IDs already present
+        # so reruns don't fill the filter with duplicates
+        try:
+            # Reserve explicitly: INSERTNX would create the filter with the
+            # default bucket size and a higher false positive rate
+            try:
+                redis_client.execute_command(
+                    'CF.RESERVE',
+                    BLOOM_FILTER_KEY,
+                    BLOOM_FILTER_CAPACITY,
+                    'BUCKETSIZE',
+                    CUCKOO_FILTER_BUCKET_SIZE
+                )
+            except redis.exceptions.ResponseError as e:
+                if "exists" not in str(e):
+                    raise
+            for i in range(0, len(valid_student_ids), BLOOM_FILTER_BATCH_SIZE):
+                redis_client.execute_command(
+                    'CF.INSERTNX',
+                    BLOOM_FILTER_KEY,
+                    'NOCREATE',
+                    'ITEMS',
+                    *valid_student_ids[i:i + BLOOM_FILTER_BATCH_SIZE]
+                )
+            logger.info(f"Added {len(valid_student_ids)} valid student IDs to Cuckoo Filter")
+        except redis.exceptions.ResponseError as e:
+            if "already exists" not in str(e):
+                logger.error(f"Error adding student IDs to Cuckoo Filter: {e}")
+        
+        # Generate 50 distinct invalid student IDs in [100000, 999999]
+        invalid_student_ids = (rng.choice(900000, size=50, replace=False) + 100000).tolist()
         
-        # Generate some invalid student IDs
-        invalid_student_ids = set(faker.unique.random_int(min=100000, max=999999) 
-                                for _ in range(50))  # Generate 50 invalid IDs
+        # Draw every attendance record up front in student order
+        (record_students, record_days, entry_times, exit_times,
+         has_invalid, invalid_picks) = _generate_attendance_schedule(
+            rng, valid_student_ids, len(past_week_dates), len(invalid_student_ids)
+        )
+        day_starts = np.array(
+            [day.replace(hour=0, minute=0, second=0, microsecond=0) for day in past_week_dates],
+            dtype='datetime64[m]'
+        )
+        # Timestamps are sent as epoch milliseconds, treating wall-clock times
+        # as UTC the same way the Cassandra driver stores naive datetimes
+        entry_timestamps = (day_starts[record_days] + entry_times).astype('datetime64[ms]').astype(np.int64)
+        exit_timestamps = (day_starts[record_days] + exit_times).astype('datetime64[ms]').astype(np.int64)
         
-        # Each student has different attendance patterns
-        for student_id in valid_student_ids:
-            # Randomly decide if this student is generally punctual or often late
-            is_punctual = random.random() > 0.2  # 80% students are generally punctual
+        # Entry and exit both fall on the same calendar day
+        day_lecture_ids = [f"LECTURE_{day.strftime('%Y%m%d')}" for day in past_week_dates]
+        
+        for student_id, day_index, entry_timestamp, exit_timestamp, invalid, invalid_pick in zip(
+            record_students.tolist(), record_days.tolist(), entry_timestamps.tolist(),
+            exit_timestamps.tolist(), has_invalid.tolist(), invalid_picks.tolist()
+        ):
+            lecture_id = day_lecture_ids[day_index]
             
-            # Randomly decide how many days this student attends (between 3-7 days)
-            attendance_days = random.sample(past_week_dates, random.randint(3, 7))
+            # Create entry record
+            entry_data = {
+                'student_id': student_id,
+                'timestamp': entry_timestamp,
+                'lecture_id': lecture_id,
+                'is_valid': True,
+                'event_type': 'entry'
+            }
             
-            for day in attendance_days:
-                # Generate entry time based on student's punctuality
-                if is_punctual:
-                    entry_hour = random.randint(8, 9)  # Arrives between 8-9 AM
-                else:
-                    entry_hour = random.randint(9, 11)  # Arrives between 9-11 AM
-                
-                entry_time = day.replace(
-                    hour=entry_hour,
-                    minute=random.randint(0, 59),
-                    second=0,
-                    microsecond=0
-                )
-                
-                # Generate exit time (3-4 hours after entry)
-                exit_time = entry_time + timedelta(
-                    hours=random.randint(3, 4),
-                    minutes=random.randint(0, 59)
-                )
-                
-                # Create entry record
-                entry_data = {
-                    'student_id': student_id,
-                    'timestamp': entry_time.isoformat(),
-                    'lecture_id': f"LECTURE_{entry_time.strftime('%Y%m%d')}",
-                    'is_valid': True,
+            # Send entry message to Pulsar
+            message = orjson.dumps(entry_data)
+            producer.send_async(message, _on_send)
+            message_count += 1
+            
+            # Create exit record
+            exit_data = {
+                'student_id': student_id,
+                'timestamp': exit_timestamp,
+                'lecture_id': lecture_id,
+                'is_valid': True,
+                'event_type': 'exit'
+            }
+            
+            # Send exit message to Pulsar
+            message = orjson.dumps(exit_data)
+            producer.send_async(message, _on_send)
+            message_count += 1
+            
+            # Generate invalid attendance attempts (15% chance)
+            if invalid:
+                invalid_id = invalid_student_ids[invalid_pick]
+                invalid_data = {
+                    'student_id': invalid_id,
+                    'timestamp': entry_timestamp,
+                    'lecture_id': lecture_id,
+                    'is_valid': False,
                     'event_type': 'entry'
                 }
-                
-                # Send entry message to Pulsar
-                message = json.dumps(entry_data).encode('utf-8')
-                producer.send(message)
+                message = orjson.dumps(invalid_data)
+                producer.send_async(message, _on_send)
                 message_count += 1
-                
-                # Create exit record
-                exit_data = {
-                    'student_id': student_id,
-                    'timestamp': exit_time.isoformat(),
-                    'lecture_id': f"LECTURE_{exit_time.strftime('%Y%m%d')}",
-                    'is_valid': True,
-                    'event_type': 'exit'
-                }
-                
-                # Send exit message to Pulsar
-                message = json.dumps(exit_data).encode('utf-8')
-                producer.send(message)
-                message_count += 1
-                
-                # Generate invalid attendance attempts (15% chance)
-                if random.random() < 0.15:
-                    invalid_id = random.choice(list(invalid_student_ids))
-                    invalid_data = {
-                        'student_id': invalid_id,
-                        'timestamp': entry_time.isoformat(),
-                        'lecture_id': f"LECTURE_{entry_time.strftime('%Y%m%d')}",
-                        'is_valid': False,
-                        'event_type': 'entry'
-                    }
-                    message = json.dumps(invalid_data).encode('utf-8')
-                    producer.send(message)
-                    message_count += 1
-                    invalid_attempts += 1
-                    logger.info(f"Generated invalid attendance attempt for ID: {invalid_id}")
-                
-                if message_count % 100 == 0:  # Log every 100 messages
-                    logger.info(f"Generated {message_count} attendance records ({invalid_attempts} invalid attempts)")
-                
-                # Small delay between records
-                time.sleep(random.uniform(0.1, 0.5))
+                invalid_attempts += 1
+                logger.info(f"Generated invalid attendance attempt for ID: {invalid_id}")
+            
+            if message_count % 100 == 0:  # Log every 100 messages
+                logger.info(f"Generated {message_count} attendance records ({invalid_attempts} invalid attempts)")
         
         # Generate some standalone invalid attempts
         for _ in range(20):  # Generate 20 additional invalid attempts
-            invalid_id = random.choice(list(invalid_student_ids))
-            random_day = random.choice(past_week_dates)
-            random_time = random_day.replace(
+            invalid_id = random.choice(invalid_student_ids)
+            day_index = random.randrange(len(past_week_dates))
+            random_time = past_week_dates[day_index].replace(
                 hour=random.randint(8, 17),
                 minute=random.randint(0, 59),
                 second=0,
@@ -171,24 +240,23 @@ def generate_student_data():
             
             invalid_data = {
                 'student_id': invalid_id,
-                'timestamp': random_time.isoformat(),
-                'lecture_id': f"LECTURE_{random_time.strftime('%Y%m%d')}",
+                'timestamp': calendar.timegm(random_time.timetuple()) * 1000,
+                'lecture_id': day_lecture_ids[day_index],
                 'is_valid': False,
                 'event_type': 'entry'
             }
-            message = json.dumps(invalid_data).encode('utf-8')
-            producer.send(message)
+            message = orjson.dumps(invalid_data)
+            producer.send_async(message, _on_send)
             message_count += 1
             invalid_attempts += 1
             logger.info(f"Generated standalone invalid attendance attempt for ID: {invalid_id}")
             
-            time.sleep(random.uniform(0.1, 0.5))
-            
     except KeyboardInterrupt:
         logger.info(f"\nStopping data generation... Total messages sent: {message_count} ({invalid_attempts} invalid attempts)")
     except Exception as e:
         logger.error(f"Error generating data: {e}")
     finally:
+        producer.flush()
         client.close()
         redis_client.close()
 